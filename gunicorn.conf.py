@@ -0,0 +1,17 @@
+"""
+Gunicorn configuration for the plate pusher.
+
+    gunicorn -c gunicorn.conf.py send_plates:app
+
+gevent workers (the default) let concurrent /send_plates requests overlap
+their ShotGrid and FileMaker network waits instead of queuing behind each
+other. Set GUNICORN_WORKER_CLASS=gthread to use plain threaded workers.
+"""
+import os
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gevent")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get("GUNICORN_WORKERS", 2))
+worker_connections = int(os.environ.get("GUNICORN_WORKER_CONNECTIONS", 1000))
+threads = int(os.environ.get("GUNICORN_THREADS", 4))
@@ -1,16 +1,73 @@
 import os
-import json
+import atexit
+import logging
+import queue
+import re
+import threading
+import time
+import traceback
+import orjson
 import requests
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+from logging.handlers import QueueHandler, QueueListener
 from base64 import b64encode
+from requests.adapters import HTTPAdapter
 from shotgun_api3 import Shotgun
+from urllib3.util.retry import Retry
+
+# gunicorn's gevent worker monkey-patches the stdlib before loading the app,
+# so blocking socket calls in requests and shotgun_api3 already yield to
+# other greenlets. Detect that rather than relying on configuration.
+try:
+    from gevent import spawn as gevent_spawn
+    from gevent.monkey import is_module_patched
+    from gevent.pool import Pool as GeventPool
+except ImportError:
+    USE_GEVENT = False
+else:
+    USE_GEVENT = is_module_patched("socket")
+
+
+class OrjsonProvider(JSONProvider):
+    """Flask JSON provider backed by orjson, so jsonify() skips the stdlib encoder."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS, default=str).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # ---------------------------
 # CONFIGURATION
 # ---------------------------
 
+_TRUTHY = frozenset({"1", "true", "yes", "on", "y", "t"})
+
+# One whole comma-separated token of digits (surrounding whitespace allowed).
+_ID_RE = re.compile(r"(?:^|,)\s*(\d+)\s*(?=,|$)", re.ASCII)
+
+DEBUG = os.environ.get("DEBUG", "").lower() in _TRUTHY
+
+# Log records are handed to a queue and written to stderr by a listener
+# thread, so request handlers never block on the log stream.
+logger = logging.getLogger("send_plates")
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+_log_listener = QueueListener(_log_queue, _log_stream)
+logger.addHandler(QueueHandler(_log_queue))
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
 SG_URL = os.environ.get("SG_URL")
 SG_SCRIPT_NAME = os.environ.get("SG_SCRIPT_NAME")
 SG_SCRIPT_KEY = os.environ.get("SG_SCRIPT_KEY")
@@ -21,65 +78,314 @@ FMP_LAYOUT = os.environ.get("FMP_LAYOUT")
 FMP_USER = os.environ.get("FMP_USER")
 FMP_PASSWORD = os.environ.get("FMP_PASSWORD")
 
+_REQUIRED_ENV = ("SG_URL", "SG_SCRIPT_NAME", "SG_SCRIPT_KEY",
+                 "FMP_BASE_URL", "FMP_DATABASE", "FMP_LAYOUT", "FMP_USER", "FMP_PASSWORD")
+_missing_env = [name for name in _REQUIRED_ENV if not globals()[name]]
+if _missing_env:
+    raise RuntimeError(f"Missing required environment variables: {', '.join(_missing_env)}")
+
+# Env-derived FileMaker endpoints and credentials, built once.
+_FMP_SESSIONS_URL = f"{FMP_BASE_URL}/fmi/data/vLatest/databases/{FMP_DATABASE}/sessions"
+_FMP_RECORDS_URL = f"{FMP_BASE_URL}/fmi/data/vLatest/databases/{FMP_DATABASE}/layouts/{FMP_LAYOUT}/records"
+_FMP_BASIC_AUTH = "Basic " + b64encode(f"{FMP_USER}:{FMP_PASSWORD}".encode("utf-8")).decode("utf-8")
+
+# Records are sent to FileMaker in chunks of FMP_BATCH_SIZE, with at most
+# FMP_MAX_WORKERS chunks in flight to avoid piling up on the FMS session.
+# The token is shared by the whole process, so the cap is too: every create
+# POST holds a slot of _FMP_CREATE_SLOTS, whatever request it belongs to.
+FMP_BATCH_SIZE = int(os.environ.get("FMP_BATCH_SIZE", 500))
+FMP_MAX_WORKERS = int(os.environ.get("FMP_MAX_WORKERS", 4))
+# At most SG_POOL_SIZE idle ShotGrid clients are kept per process.
+SG_POOL_SIZE = int(os.environ.get("SG_POOL_SIZE", 8))
+_bad_sizes = [name for name in ("FMP_BATCH_SIZE", "FMP_MAX_WORKERS", "SG_POOL_SIZE") if globals()[name] < 1]
+if _bad_sizes:
+    raise RuntimeError(f"Environment variables must be at least 1: {', '.join(_bad_sizes)}")
+_FMP_CREATE_SLOTS = threading.BoundedSemaphore(FMP_MAX_WORKERS)
+
+# FileMaker sessions expire after 15 minutes idle; the cached token is
+# refreshed a little before that.
+FMP_TOKEN_TTL = 14 * 60
+_FM_TOKEN = {"token": None, "expires_at": 0.0}
+_FM_TOKEN_LOCK = threading.Lock()
+
+# Retired session tokens are closed by a background thread, off the request path.
+_CLOSE_Q = queue.Queue()
+_CLOSER = None
+_CLOSER_LOCK = threading.Lock()
+
+# Idle ShotGrid clients, reused across requests. A Shotgun instance holds a
+# single HTTP connection and is not safe to share, so each request checks one
+# out for its exclusive use and returns it afterwards. Clients beyond
+# SG_POOL_SIZE are dropped on return, so a burst doesn't leave them idle.
+_SG_POOL = queue.Queue(maxsize=SG_POOL_SIZE)
+
+# Shared HTTP session so token/create/close calls (and consecutive requests)
+# reuse the same pooled keep-alive connection to FileMaker.
+FMP_SESSION = requests.Session()
+FMP_SESSION.headers.update({"Content-Type": "application/json"})
+# The pool holds one connection per create slot plus two for the session
+# POST (serialized by _FM_TOKEN_LOCK) and the background close DELETE, so
+# connections at the process-wide concurrency cap are kept alive instead of
+# discarded. Retries back off exponentially and honour Retry-After so a
+# throttling FMS isn't hammered harder. POST is left
+# out of allowed_methods: a create behind a proxy 5xx may already have been
+# committed, so it is only retried on connection errors. When retries run
+# out, the last response is returned instead of raising.
+FMP_SESSION.mount(
+    FMP_BASE_URL,
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=FMP_MAX_WORKERS + 2,
+        max_retries=Retry(
+            total=4,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=frozenset(["GET", "DELETE"]),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        ),
+    ),
+)
+
 # ---------------------------
 # HELPERS
 # ---------------------------
 
-def get_sg_connection():
-    """Return authenticated ShotGrid API connection."""
-    if not all([SG_URL, SG_SCRIPT_NAME, SG_SCRIPT_KEY]):
-        raise RuntimeError("Missing ShotGrid environment credentials.")
-    return Shotgun(SG_URL, SG_SCRIPT_NAME, SG_SCRIPT_KEY)
+@contextmanager
+def sg_connection():
+    """Check a ShotGrid API connection out of the pool, creating one if none is idle."""
+    try:
+        sg = _SG_POOL.get_nowait()
+    except queue.Empty:
+        sg = Shotgun(SG_URL, SG_SCRIPT_NAME, SG_SCRIPT_KEY, connect=False)
+    try:
+        yield sg
+    finally:
+        try:
+            _SG_POOL.put_nowait(sg)
+        except queue.Full:
+            sg.close()
 
 
 def fm_get_token():
     """Authenticate with FileMaker Data API and return session token."""
-    sess_url = f"{FMP_BASE_URL}/fmi/data/vLatest/databases/{FMP_DATABASE}/sessions"
-    auth_string = f"{FMP_USER}:{FMP_PASSWORD}"
-    auth_base64 = b64encode(auth_string.encode("utf-8")).decode("utf-8")
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Basic {auth_base64}",
-    }
-    r = requests.post(sess_url, headers=headers)
+    r = FMP_SESSION.post(_FMP_SESSIONS_URL, headers={"Authorization": _FMP_BASIC_AUTH})
     if r.status_code not in (200, 201):
         raise RuntimeError(f"Failed to create FileMaker session: {r.status_code} {r.text}")
-    token = r.json().get("response", {}).get("token")
+    payload = orjson.loads(r.content)
+    token = payload.get("response", {}).get("token")
     if not token:
-        raise RuntimeError(f"No token found in FileMaker session response: {r.json()}")
+        raise RuntimeError(f"No token found in FileMaker session response: {payload}")
     return token
 
 
+def get_fm_token():
+    """Return a cached FileMaker session token, authenticating when it is missing or stale."""
+    if _FM_TOKEN["token"] and time.monotonic() < _FM_TOKEN["expires_at"] - 60:
+        return _FM_TOKEN["token"]
+    with _FM_TOKEN_LOCK:
+        if not (_FM_TOKEN["token"] and time.monotonic() < _FM_TOKEN["expires_at"] - 60):
+            stale = _FM_TOKEN["token"]
+            _FM_TOKEN["token"] = fm_get_token()
+            if stale:
+                fm_close_session_async(stale)
+            _FM_TOKEN["expires_at"] = time.monotonic() + FMP_TOKEN_TTL
+        return _FM_TOKEN["token"]
+
+
+def invalidate_fm_token(token):
+    """Drop the cached token if it is still the one FileMaker rejected."""
+    with _FM_TOKEN_LOCK:
+        if _FM_TOKEN["token"] == token:
+            _FM_TOKEN["token"] = None
+            _FM_TOKEN["expires_at"] = 0.0
+
+
 def fm_close_session(token):
     """Close FileMaker session (cleanup)."""
     try:
-        url = f"{FMP_BASE_URL}/fmi/data/vLatest/databases/{FMP_DATABASE}/sessions/{token}"
-        requests.delete(url, headers={"Authorization": f"Bearer {token}"})
+        FMP_SESSION.delete(f"{_FMP_SESSIONS_URL}/{token}", headers={"Authorization": f"Bearer {token}"})
     except Exception:
         pass
 
 
+def _closer():
+    while True:
+        fm_close_session(_CLOSE_Q.get())
+
+
+def fm_close_session_async(token):
+    """Queue a FileMaker session for closing on the background closer thread."""
+    global _CLOSER
+    if _CLOSER is None:
+        with _CLOSER_LOCK:
+            if _CLOSER is None:
+                _CLOSER = threading.Thread(target=_closer, name="fm-session-closer", daemon=True)
+                _CLOSER.start()
+    _CLOSE_Q.put(token)
+
+
+def fm_create_records(token, records):
+    """Create records on the configured FileMaker layout and return the response."""
+    data = orjson.dumps({"records": records}, default=str)
+    with _FMP_CREATE_SLOTS:
+        return FMP_SESSION.post(_FMP_RECORDS_URL, headers={"Authorization": f"Bearer {token}"}, data=data)
+
+
+def fm_send_records(records):
+    """Create records with the cached token, re-authenticating once if FileMaker rejects it.
+
+    Returns ``{"status": ..., "created": ..., "response": ...}`` for the chunk. A
+    chunk that fails to send comes back with ``status`` None and an ``error``
+    instead of raising, so the other chunks' results are kept.
+    """
+    try:
+        token = get_fm_token()
+        r = fm_create_records(token, records)
+        if r.status_code == 401:
+            invalidate_fm_token(token)
+            r = fm_create_records(get_fm_token(), records)
+    except Exception as e:
+        logger.exception("Failed to send a chunk of %d records to FileMaker", len(records))
+        return {"status": None, "created": 0, "error": str(e)}
+
+    try:
+        result = orjson.loads(r.content)
+    except orjson.JSONDecodeError:
+        result = r.text
+    if r.status_code in (200, 201) and isinstance(result, dict):
+        created = len(result.get("response", {}).get("data", []))
+    else:
+        logger.warning("FileMaker rejected a chunk of %d records: %s", len(records), r.status_code)
+        created = 0
+    return {"status": r.status_code, "created": created, "response": result}
+
+
+def fan_out(fn, items, size):
+    """Call ``fn`` on each item, at most ``size`` at a time, returning results in order.
+
+    Under gevent workers this uses a greenlet pool on the worker's own event
+    loop; otherwise a thread pool.
+    """
+    size = max(1, min(size, len(items)))
+    if USE_GEVENT:
+        return GeventPool(size).map(fn, items)
+    with ThreadPoolExecutor(max_workers=size) as ex:
+        return list(ex.map(fn, items))
+
+
+def start_background(fn):
+    """Start ``fn()`` concurrently and return a callable that waits for its result.
+
+    Under gevent workers this spawns a greenlet; otherwise it runs on a
+    one-off worker thread.
+    """
+    if USE_GEVENT:
+        return gevent_spawn(fn).get
+    ex = ThreadPoolExecutor(max_workers=1)
+    future = ex.submit(fn)
+    ex.shutdown(wait=False)
+    return future.result
+
+
+# ---------------------------
+# FIELD MAPPING
+# ---------------------------
+
+_MISSING = object()
+
+
+def _scalar(value):
+    return value if value not in (None, "", [], {}) else _MISSING
+
+
+def _latest_name(value):
+    return _scalar((value or {}).get("name"))
+
+
+def _shot_fk(value):
+    return _scalar((value or {}).get("id"))
+
+
+# (ShotGrid field, FileMaker field, extractor) -- built once at import.
+_MAPPING = (
+    ("sg_latest_version", "Plate Name", _latest_name),
+    ("sg_slate", "Slate", _scalar),
+    ("sg_camera_file_name", "Source File Name", _scalar),
+    ("sg_source_in", "Timecode In", _scalar),
+    ("sg_source_out", "Timecode Out", _scalar),
+    ("sg_turnover", "Turnover Package", _scalar),
+    ("sg_head_in", "Head In", _scalar),
+    ("sg_cut_in", "Cut In", _scalar),
+    ("sg_cut_out", "Cut Out", _scalar),
+    ("sg_tail_out", "Tail Out", _scalar),
+    ("sg_lut", "LUT", _scalar),
+    ("description", "Notes", _scalar),
+    ("shot", "ForeignKey", _shot_fk),
+)
+
+# Exactly the ShotGrid fields the mapping reads.
+SG_FIELDS = ["id"] + [sg for sg, _, _ in _MAPPING]
+
+
+def _build_mapper(mapping):
+    """Compile a flat mapper function specialized to ``mapping``.
+
+    Plain fields get their emptiness check inlined; fields with a custom
+    extractor call it directly. The result has no per-field table dispatch.
+    """
+    ns = {"_MISSING": _MISSING}
+    lines = ["def map_element(el):", "    get = el.get", "    out = {}"]
+    for i, (sg, fmp, fn) in enumerate(mapping):
+        if fn is _scalar:
+            lines.append(f"    v = get({sg!r})")
+            lines.append(f"    if v not in (None, '', [], {{}}): out[{fmp!r}] = v")
+        else:
+            ns[f"_fn{i}"] = fn
+            lines.append(f"    v = _fn{i}(get({sg!r}))")
+            lines.append(f"    if v is not _MISSING: out[{fmp!r}] = v")
+    lines.append("    return out")
+    exec(compile("\n".join(lines) + "\n", "<map_element>", "exec"), ns)
+    mapper = ns["map_element"]
+    mapper.__doc__ = "Map a ShotGrid Element to FileMaker fieldData, dropping empty values."
+    return mapper
+
+
+map_element = _build_mapper(_MAPPING)
+
+
 # ---------------------------
 # MAIN ENDPOINT
 # ---------------------------
 
 @app.route("/send_plates", methods=["POST", "GET"])
 def send_plates():
-    # Grab parameters from query string (GET) or form/json body (POST)
-    if request.method == "POST":
-        entity_type = request.args.get("entity_type") or request.form.get("entity_type") or "Element"
-        selected_ids_raw = request.args.get("selected_ids") or request.form.get("selected_ids") or ""
-        debug_flag = (request.args.get("debug") or request.form.get("debug") or "").lower() in ("1", "true", "yes")
-    else:  # GET
-        entity_type = request.args.get("entity_type", "Element")
-        selected_ids_raw = request.args.get("selected_ids", "")
-        debug_flag = request.args.get("debug", "").lower() in ("1", "true", "yes")
+    # JSON bodies are read once straight off the stream; form bodies are parsed
+    # into request.form instead, so get_data() comes back empty for them.
+    raw = request.get_data(cache=False, parse_form_data=True).lstrip(b"\xef\xbb\xbf \t\r\n")
+    try:
+        body = orjson.loads(raw) if raw[:1] in (b"{", b"[") else {}
+    except orjson.JSONDecodeError:
+        return jsonify({"error": "Invalid JSON body"}), 400
+    if isinstance(body, list):
+        body = {"entity_ids": body}
+
+    # Grab parameters from query string or form body (request.values merges both),
+    # falling back to the JSON body
+    entity_type = request.values.get("entity_type") or body.get("entity_type") or "Element"
+    if not isinstance(entity_type, str):
+        return jsonify({"error": "Invalid entity_type"}), 400
+    selected_ids_raw = request.values.get("selected_ids") or body.get("selected_ids") or body.get("entity_ids") or ""
+    if isinstance(selected_ids_raw, list):
+        selected_ids_raw = ",".join(str(x) for x in selected_ids_raw)
+    # DEBUG in the environment pins debug mode on for every request.
+    debug_flag = DEBUG or str(request.values.get("debug") or body.get("debug") or "").lower() in _TRUTHY
 
     if debug_flag:
-        print("🟡 DEBUG MODE ENABLED")
+        logger.info("🟡 DEBUG MODE ENABLED")
 
     try:
-        selected_ids = [int(x) for x in selected_ids_raw.split(",") if x.strip().isdigit()]
+        selected_ids = sorted(set(map(int, _ID_RE.findall(selected_ids_raw))))
     except Exception:
         return jsonify({"error": "Invalid selected_ids"}), 400
 
@@ -87,81 +393,70 @@ def send_plates():
         return jsonify({"error": "No valid IDs provided"}), 400
 
     # --- now your normal SG query and FMP sending logic ---
-    sg = get_sg_connection()
-
-    fields = [
-        "id",
-        "sg_latest_version",
-        "sg_latest_version.Code",
-        "sg_slate",
-        "sg_camera_file_name",
-        "sg_source_in",
-        "sg_source_out",
-        "sg_turnover",
-        "sg_head_in",
-        "sg_cut_in",
-        "sg_cut_out",
-        "sg_tail_out",
-        "sg_lut",
-        "description",
-        "shot",
-        "shot.code",
-    ]
     if debug_flag:
-        print("Querying ShotGrid fields:", fields)
+        logger.info("Querying ShotGrid fields: %s", SG_FIELDS)
 
-    elements = sg.find(entity_type, [["id", "in", selected_ids]], fields)
+    # The ShotGrid query and FileMaker auth hit different hosts, so fetch the
+    # token in the background while the query runs on this request.
+    token_result = start_background(get_fm_token)
+    with sg_connection() as sg:
+        elements = sg.find(entity_type, [["id", "in", selected_ids]], SG_FIELDS)
 
     if debug_flag:
-        print(f"Found {len(elements)} results")
-        print("SG element fields for debug:")
-        for el in elements:
-            print(json.dumps(el, indent=2, default=str))
+        logger.info("Found %d results", len(elements))
+        logger.info(
+            "SG elements:\n%s",
+            orjson.dumps(elements, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS, default=str).decode(),
+        )
 
     # --- MAP TO FILEMAKER ---
-    fm_records = []
-    for el in elements:
-        plate_name = el.get("sg_latest_version", {}).get("name")
-        foreign_key = el.get("shot", {}).get("id")
-        mapped_fields = {
-            "Plate Name": plate_name,
-            "Slate": el.get("sg_slate"),
-            "Source File Name": el.get("sg_camera_file_name"),
-            "Timecode In": el.get("sg_source_in"),
-            "Timecode Out": el.get("sg_source_out"),
-            "Turnover Package": el.get("sg_turnover"),
-            "Head In": el.get("sg_head_in"),
-            "Cut In": el.get("sg_cut_in"),
-            "Cut Out": el.get("sg_cut_out"),
-            "Tail Out": el.get("sg_tail_out"),
-            "LUT": el.get("sg_lut"),
-            "Notes": el.get("description"),
-            "ForeignKey": foreign_key,
-        }
-        fm_field_data = {k: v for k, v in mapped_fields.items() if v not in (None, "", [])}
-        fm_records.append({"fieldData": fm_field_data})
+    fm_records = [{"fieldData": field_data} for el in elements if (field_data := map_element(el))]
+    if not fm_records:
+        return jsonify({"message": "No records had fieldData; nothing sent to FileMaker.", "created": 0})
 
     # --- SEND TO FILEMAKER ---
+    chunks = [fm_records[i:i + FMP_BATCH_SIZE] for i in range(0, len(fm_records), FMP_BATCH_SIZE)]
     try:
-        token = fm_get_token()
-        url = f"{FMP_BASE_URL}/fmi/data/vLatest/databases/{FMP_DATABASE}/layouts/{FMP_LAYOUT}/records"
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-        r = requests.post(url, headers=headers, json={"records": fm_records})
-        result = r.json()
+        token_result()
+        sent = fan_out(fm_send_records, chunks, FMP_MAX_WORKERS)
     except Exception as e:
-        return jsonify({"error": f"Failed to send to FileMaker: {e}"}), 500
+        logger.exception("Failed to send to FileMaker")
+        body = {"error": f"Failed to send to FileMaker: {e}"}
+        if debug_flag:
+            body["trace"] = traceback.format_exc()
+        return jsonify(body), 500
+
+    created = sum(chunk["created"] for chunk in sent)
+    failed = [chunk for chunk in sent if chunk["status"] not in (200, 201)]
 
-    return jsonify({
-        "message": f"✅ Sent {len(fm_records)} records to FileMaker.",
-        "records": fm_records,
-        "filemaker_response": result if debug_flag else "hidden (debug off)"
-    })
+    if failed:
+        message = f"⚠️ Created {created} of {len(fm_records)} records in FileMaker; {len(failed)} chunk(s) failed."
+    else:
+        message = f"✅ Created {created} of {len(fm_records)} records in FileMaker."
+    body = {
+        "message": message,
+        "created": created,
+    }
+    if failed:
+        body["details"] = [{k: v for k, v in chunk.items() if k != "created"} for chunk in failed]
+    if debug_flag:
+        body["records"] = fm_records
+        body["filemaker_response"] = [chunk.get("response") for chunk in sent]
+    return Response(
+        orjson.dumps(body, default=str),
+        status=502 if failed and not created else 200,
+        mimetype="application/json",
+        direct_passthrough=True,
+    )
 
 # ---------------------------
 # MAIN
 # ---------------------------
 
 if __name__ == "__main__":
-    DEBUG = os.environ.get("DEBUG", "").lower() in ("1", "true", "yes")
+    # The Werkzeug dev server handles one request at a time; production runs
+    # under gunicorn (see gunicorn.conf.py).
+    if os.environ.get("USE_DEV_SERVER", "").lower() not in _TRUTHY:
+        raise SystemExit("Run with: gunicorn -c gunicorn.conf.py send_plates:app (or set USE_DEV_SERVER=1)")
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=DEBUG)